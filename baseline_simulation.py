@@ -1,21 +1,66 @@
+"""
+Baseline wealth-tax simulation for the Spanish autonomous regions.
+
+Pipeline stages take ownership of the DataFrame they are given: they add or
+overwrite columns in place and return it. Copy before calling if the input
+must stay untouched.
+"""
 import pandas as pd
 import numpy as np
 import random
 import logging
-import unicodedata
+import argparse
+from functools import lru_cache
+from pathlib import Path
+from types import MappingProxyType
 
 np.random.seed(42)
 random.seed(42)
 logging.basicConfig(level=logging.INFO)
 
+# EFF net-wealth percentile groups, from poorest to richest
+WEALTH_CATEGORIES = ["under 25", "between 25 and 50", "between 50 and 75", "between 75 and 90", "between 90 and 100"]
+VALID_WEALTH_CATEGORIES = frozenset(WEALTH_CATEGORIES)
+WEALTH_CATEGORY_DTYPE = pd.CategoricalDtype(WEALTH_CATEGORIES, ordered=True)
+# Per-group composition shares in [0, 1]; float32 is ample for these and halves their footprint
+ASSET_RATIO_COLUMNS = ["Real_Asset_Ratio", "Financial_Asset_Ratio", "Debt_Ratio", "Business_Asset_Ratio"]
+
+
+# Bump whenever _read_eff_data's filtering or normalization changes, so caches built
+# by an older version are not reused
+_EFF_CACHE_VERSION = 1
+
+
+def load_eff_data(file_path="eff_data.xlsx", use_cache=True):
+    """
+    Filtered EFF rows for the 2022 wave. Parsing the workbook is slow, so the result is
+    cached next to it as a pickle and reused for as long as neither the workbook nor
+    _EFF_CACHE_VERSION changes.
+    The cache is best-effort: an unreadable cache is rebuilt and a failed write is ignored.
+    """
+    source = Path(file_path)
+    cache = source.with_suffix(f".v{_EFF_CACHE_VERSION}.cached.pkl")
+    if use_cache and cache.exists() and cache.stat().st_mtime >= source.stat().st_mtime:
+        try:
+            return pd.read_pickle(cache)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable EFF cache {cache}: {e}")
+
+    filtered = _read_eff_data(source)
+    if use_cache:
+        try:
+            filtered.to_pickle(cache)
+        except OSError as e:
+            logging.warning(f"Could not write EFF cache {cache}: {e}")
+    return filtered
+
 
-def load_eff_data(file_path="eff_data.xlsx"):
+def _read_eff_data(file_path):
     eff_df = pd.read_excel(file_path, sheet_name="Datos", skiprows=10)
     eff_df.columns = ["Concept", "Element", "Statistic", "Breakdown", "Category", "Measure", "Wave", "Value"]
     eff_df["Wave"] = pd.to_numeric(eff_df["Wave"], errors="coerce")
     eff_df["Value"] = pd.to_numeric(eff_df["Value"], errors="coerce")
     eff_df["Value"] *= 1000
-    eff_df["Category"] = eff_df["Category"].astype(str).str.strip().str.replace("\u2013", "-", regex=False)
 
     filtered = eff_df[
         (eff_df["Wave"] == 2022) &
@@ -23,14 +68,12 @@ def load_eff_data(file_path="eff_data.xlsx"):
         (eff_df["Statistic"].str.upper() == "MEAN") &
         (eff_df["Value"].notna())
         ].copy()
-    # Filter to valid wealth groups only
-    valid_categories = [
-        "under 25", "between 25 and 50",
-        "between 50 and 75", "between 75 and 90",
-        "between 90 and 100"
-    ]
-    filtered["Category"] = filtered["Category"].str.lower().str.strip()
-    filtered = filtered[filtered["Category"].isin(valid_categories)]
+    # Normalize the group labels once, here, for every downstream consumer;
+    # then filter to valid wealth groups only
+    filtered["Category"] = (
+        filtered["Category"].astype(str).str.strip().str.replace("\u2013", "-", regex=False).str.lower()
+    )
+    filtered = filtered[filtered["Category"].isin(VALID_WEALTH_CATEGORIES)]
 
     return filtered
 
@@ -54,7 +97,11 @@ def process_eff_assets_income(filtered_df):
         missing = expected_columns - set(filtered_df["Element"].unique())
         raise ValueError(f"Missing expected elements in data: {missing}")
 
-    pivot_df = filtered_df.pivot_table(index="Category", columns="Element", values="Value", aggfunc="mean").fillna(0)
+    pivot_df = (
+        filtered_df.groupby(["Category", "Element"])["Value"]
+        .mean()
+        .unstack("Element", fill_value=0.0)
+    )
 
     pivot_df["Real_Assets"] = pivot_df[real_assets].sum(axis=1)
     pivot_df["Financial_Assets"] = pivot_df[financial_assets].sum(axis=1)
@@ -80,7 +127,6 @@ def process_eff_assets_income(filtered_df):
     pivot_df = pivot_df.merge(business_df, on="Category", how="left")
     pivot_df["Business_Assets"] = pivot_df["Business_Assets"].fillna(0.0)
     pivot_df["Business_Asset_Ratio"] = pivot_df["Business_Assets"] / pivot_df["Total_Assets"].replace(0, np.nan)
-    pivot_df["Category"] = pivot_df["Category"].astype(str).str.strip().str.lower()
 
     group_stats_df = pivot_df.drop_duplicates(subset="Category")[[
         "Category", "Total_Assets", "Debts", "Net_Wealth",
@@ -97,24 +143,33 @@ def reweight_to_match_percentile_shares(
     weight_col="Weight",
     percentiles=10
 ):
-    df_copy = dataframe.copy()
-
     # Auto-calculate Net_Wealth if missing
-    if value_col not in df_copy.columns:
-        if "Total_Assets" in df_copy.columns and "Debts" in df_copy.columns:
+    if value_col not in dataframe.columns:
+        if "Total_Assets" in dataframe.columns and "Debts" in dataframe.columns:
             print(f"ℹ️ {value_col} not found. Auto-calculating it as Total_Assets - Debts.")
-            df_copy[value_col] = df_copy["Total_Assets"] - df_copy["Debts"]
+            values = dataframe["Total_Assets"] - dataframe["Debts"]
         else:
             raise ValueError(f"❌ Cannot compute {value_col}. Missing Total_Assets or Debts.")
+    else:
+        values = dataframe[value_col]
 
     # Ensure weights are valid
-    if weight_col not in df_copy.columns:
+    if weight_col not in dataframe.columns:
         raise ValueError(f"❌ Weight column '{weight_col}' not found in DataFrame.")
 
-    df_copy = df_copy[df_copy[value_col] >= 0].reset_index(drop=True)
-
-    df_copy["Wealth_Rank"] = df_copy[value_col].rank(method="first", pct=True)
-    df_copy["Wealth_Percentile"] = pd.qcut(df_copy["Wealth_Rank"], q=percentiles, labels=False)
+    # Boolean filtering returns a new frame, which is the only copy made here
+    keep = (values >= 0).to_numpy()
+    df_copy = dataframe[keep].reset_index(drop=True)
+    if value_col not in df_copy.columns:
+        df_copy[value_col] = values[keep].to_numpy()
+
+    # Same as rank(method="first", pct=True): a stable argsort breaks ties by row order.
+    # Equal-count bins then follow directly from the integer position i = 1..n
+    n = len(df_copy)
+    position = np.empty(n, dtype=np.int64)
+    position[np.argsort(df_copy[value_col].to_numpy(), kind="stable")] = np.arange(1, n + 1)
+    df_copy["Wealth_Rank"] = position / n
+    df_copy["Wealth_Percentile"] = (position - 1) * percentiles // n
     df_copy["Weighted_Wealth"] = df_copy[value_col] * df_copy[weight_col]
 
     actual_shares = df_copy.groupby("Wealth_Percentile")["Weighted_Wealth"].sum()
@@ -128,28 +183,57 @@ def reweight_to_match_percentile_shares(
         raise ValueError("❌ Mismatch in number of percentiles vs target shares.")
 
     scaling_factors = target_shares / actual_shares.values
-    df_copy["Scaling_Factor"] = df_copy["Wealth_Percentile"].map(dict(enumerate(scaling_factors)))
+    df_copy["Scaling_Factor"] = np.asarray(scaling_factors, dtype=np.float64)[df_copy["Wealth_Percentile"].to_numpy()]
     df_copy["Adjusted_Weight"] = df_copy[weight_col] * df_copy["Scaling_Factor"]
 
     return df_copy
 
-def calculate_population_over_30(pop_file):
-    df = pd.read_csv(pop_file)
-    df["Region"] = df["Region"].str.replace(r"^\d+\s+", "", regex=True)
-    df["Region"] = df["Region"].apply(
-        lambda x: unicodedata.normalize("NFKD", x.strip()).encode("ascii", errors="ignore").decode("utf-8").lower()
+# Read-only: shared by both population loaders
+PROVINCE_TO_REGION = MappingProxyType({
+    "madrid": "madrid", "madrid, comunidad de": "madrid",
+    "barcelona": "catalonia", "girona": "catalonia", "lleida": "catalonia", "tarragona": "catalonia", "cataluna": "catalonia",
+    "valencia/valencia": "valencia", "alicante/alacant": "valencia", "castellon/castello": "valencia", "comunitat valenciana": "valencia",
+    "coruna, a": "galicia", "lugo": "galicia", "ourense": "galicia", "pontevedra": "galicia",
+    "asturias, principado de": "asturias", "asturias": "asturias",
+    "caceres": "extremadura", "badajoz": "extremadura"
+})
+
+
+def normalize_region_names(regions):
+    """Drop the leading INE code, ASCII-fold and lowercase a Series of province labels."""
+    return (
+        regions.str.replace(r"^\d+\s+", "", regex=True)
+        .str.strip()
+        .str.normalize("NFKD")
+        .str.encode("ascii", errors="ignore")
+        .str.decode("utf-8")
+        .str.lower()
     )
 
-    province_to_region = {
-        "madrid": "madrid", "madrid, comunidad de": "madrid",
-        "barcelona": "catalonia", "girona": "catalonia", "lleida": "catalonia", "tarragona": "catalonia", "cataluna": "catalonia",
-        "valencia/valencia": "valencia", "alicante/alacant": "valencia", "castellon/castello": "valencia", "comunitat valenciana": "valencia",
-        "coruna, a": "galicia", "lugo": "galicia", "ourense": "galicia", "pontevedra": "galicia",
-        "asturias, principado de": "asturias", "asturias": "asturias",
-        "caceres": "extremadura", "badajoz": "extremadura"
-    }
 
-    df["Autonomous_Region"] = df["Region"].map(province_to_region)
+def normalize_region_categories(regions):
+    """
+    Strip and lowercase a Series of region labels as a categorical. The work is done
+    on the categories, not the rows; labels that collapse to the same name are merged.
+    """
+    regions = regions.astype("category")
+    normalized = regions.cat.categories.str.strip().str.lower()
+    categories = normalized.unique()
+    # Trailing entry keeps code -1 (missing label) missing
+    new_codes = np.append(categories.get_indexer(normalized), -1)[regions.cat.codes.to_numpy()]
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, categories), index=regions.index, name=regions.name
+    )
+
+def _load_region_populations(pop_file):
+    df = pd.read_csv(pop_file)
+    df["Region"] = normalize_region_names(df["Region"])
+    df["Autonomous_Region"] = df["Region"].map(PROVINCE_TO_REGION)
+    return df
+
+
+def calculate_population_over_30(pop_file):
+    df = _load_region_populations(pop_file)
     df = df[df["Autonomous_Region"].notna()].copy()
 
     over_30_bins = [
@@ -165,31 +249,35 @@ def calculate_population_over_30(pop_file):
     print(f" Estimated population over 30 in selected regions: {total_population:,.0f}")
     return total_population
 
-def load_population_and_revenue_data(pop_file):
-    observed_df = pd.read_csv("Cleaned_Regional_Wealth_Tax_Data.csv")
-    observed_clean = observed_df[
-        observed_df["Variable"].str.strip().str.lower() == "resultado de la declaración"
-    ].copy()
-    observed_clean["Region"] = observed_clean["Region"].str.strip().str.lower()
-    observed_clean = observed_clean.rename(columns={"Importe": "Total_Revenue"})
-    revenue_df = observed_clean[["Region", "Total_Revenue"]].copy()
-
-    pop_shares = pd.read_csv(pop_file)
-    pop_shares["Region"] = pop_shares["Region"].str.replace(r"^\d+\s+", "", regex=True)
-    pop_shares["Region"] = pop_shares["Region"].apply(
-        lambda x: unicodedata.normalize("NFKD", x.strip()).encode("ascii", errors="ignore").decode("utf-8").lower()
+@lru_cache(maxsize=1)
+def _load_observed(file_path="Cleaned_Regional_Wealth_Tax_Data.csv"):
+    """Observed wealth-tax revenue per region, indexed by normalized region name.
+
+    Cached: the returned Series is shared between calls and must not be modified.
+    """
+    # The "resultado" amounts are written in Spanish format ("606.953.200"), so
+    # let the CSV parser handle them; only the columns used here are read since
+    # the others use a plain decimal point.
+    observed_df = pd.read_csv(
+        file_path,
+        usecols=["Variable", "Importe", "Region"],
+        thousands=".",
+        decimal=",",
     )
 
-    province_to_region = {
-        "madrid": "madrid", "madrid, comunidad de": "madrid",
-        "barcelona": "catalonia", "girona": "catalonia", "lleida": "catalonia", "tarragona": "catalonia", "cataluna": "catalonia",
-        "valencia/valencia": "valencia", "alicante/alacant": "valencia", "castellon/castello": "valencia", "comunitat valenciana": "valencia",
-        "coruna, a": "galicia", "lugo": "galicia", "ourense": "galicia", "pontevedra": "galicia",
-        "asturias, principado de": "asturias", "asturias": "asturias",
-        "caceres": "extremadura", "badajoz": "extremadura"
-    }
+    # Keep only the "resultado de la declaración" rows
+    resultado = observed_df["Variable"].str.strip().str.lower() == "resultado de la declaración"
+    regions = observed_df.loc[resultado, "Region"].str.strip().str.lower()
+    return pd.Series(
+        observed_df.loc[resultado, "Importe"].to_numpy(),
+        index=pd.Index(regions.to_numpy(), name="Region"),
+        name="Total_Revenue",
+    )
+
+def load_population_and_revenue_data(pop_file):
+    revenue_df = _load_observed().reset_index()
 
-    pop_shares["Autonomous_Region"] = pop_shares["Region"].map(province_to_region)
+    pop_shares = _load_region_populations(pop_file)
     dropped = pop_shares["Autonomous_Region"].isna().sum()
     if dropped > 0:
         print(f"{dropped} rows dropped due to unmatched province mapping.")
@@ -202,10 +290,8 @@ def load_population_and_revenue_data(pop_file):
     return revenue_df, region_population
 
 def compute_region_targets(region_weights, total_households):
-    region_targets = {
-        row["Region"]: int(round(row["Population"] * total_households))
-        for _, row in region_weights.iterrows()
-    }
+    counts = np.rint(region_weights["Population"].to_numpy() * total_households).astype(np.int64)
+    region_targets = dict(zip(region_weights["Region"].to_numpy(), counts.tolist()))
     print("Computed household targets by region:")
     for region, count in region_targets.items():
         print(f"  {region}: {count} households")
@@ -252,22 +338,51 @@ def generate_scaled_households(region_weights_df, simulated_population, avg_hous
     return household_df
 
 def share_in_top_percentile(df, value_col, weight_col, top_pct=0.01):
-    df = df[df[value_col] > 0].copy()
-    df = df.sort_values(by=value_col, ascending=False)
+    vals = df[value_col].to_numpy(dtype=np.float64)
+    wts = df[weight_col].to_numpy(dtype=np.float64)
+    mask = vals > 0
+    vals = vals[mask]
+    wts = wts[mask]
 
-    total_weight = df[weight_col].sum()
+    total_weight = wts.sum()
     if total_weight == 0:
         return 0.0
-
-    df["CumWeight"] = df[weight_col].cumsum()
     cutoff = total_weight * top_pct
-    df_top = df[df["CumWeight"] <= cutoff]
 
-    total_weighted_value = (df[value_col] * df[weight_col]).sum()
-    top_weighted_value = (df_top[value_col] * df_top[weight_col]).sum()
+    # Only the largest values can fall under the weight cutoff: partially order a
+    # candidate slice and widen it (up to a full sort) until its weight covers the cutoff
+    n = len(vals)
+    k = min(n, max(1, int(n * top_pct * 2)))
+    while True:
+        cand = np.argpartition(-vals, k)[:k] if k < n else np.arange(n)
+        cand = cand[np.argsort(-vals[cand])]
+        cum_weight = np.cumsum(wts[cand])
+        if k == n or cum_weight[-1] > cutoff:
+            break
+        k = min(n, 2 * k)
+    top = cand[cum_weight <= cutoff]
+
+    total_weighted_value = (vals * wts).sum()
+    top_weighted_value = (vals[top] * wts[top]).sum()
 
     return top_weighted_value / total_weighted_value if total_weighted_value > 0 else 0.0
 
+def top_weighted_shares(values, weights, top_pcts):
+    """
+    Share of total weighted value held by the top `top_pcts` of weight (rows whose
+    cumulative weight, richest first, stays within p * total weight). One sort serves
+    every percentile; each share is a searchsorted lookup into the cumulative sums.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    order = np.argsort(-values, kind="stable")
+    w_sorted = weights[order]
+    cum_w = np.cumsum(w_sorted)
+    cum_xw = np.cumsum(values[order] * w_sorted)
+    k = np.searchsorted(cum_w, np.asarray(top_pcts) * cum_w[-1], side="right")
+    top = np.where(k > 0, cum_xw[np.maximum(k - 1, 0)], 0.0)
+    return top / cum_xw[-1]
+
 def inject_calibrated_pareto_tail(df, top1_share_target=0.20, top10_share_target=0.50, alpha=2.5, seed=42):
     rng = np.random.default_rng(seed)
     df = df.sort_values("Total_Assets", ascending=False).reset_index(drop=True)
@@ -281,11 +396,14 @@ def inject_calibrated_pareto_tail(df, top1_share_target=0.20, top10_share_target
 
     total_net_wealth = df["Net_Wealth"].sum()
 
-    weight_arr = df["Weight"].values
-    ta_arr = df["Total_Assets"].values
-    dr_arr = df["Debt_Ratio"].values
-    debt_arr = df["Debts"].values
-    nw_arr = df["Net_Wealth"].values
+    weight_arr = df["Weight"].to_numpy()
+    dr_arr = df["Debt_Ratio"].to_numpy()
+
+    # Own copies of the columns rewritten below, so the in-place edits never write
+    # through a view shared with the frame (copy-on-write safe)
+    ta_arr = df["Total_Assets"].to_numpy(copy=True)
+    debt_arr = df["Debts"].to_numpy(copy=True)
+    nw_arr = df["Net_Wealth"].to_numpy(copy=True)
 
     # --- Top 1% ---
     top1_weights = weight_arr[top1_indices]
@@ -312,37 +430,27 @@ def inject_calibrated_pareto_tail(df, top1_share_target=0.20, top10_share_target
 
 def expand_households_to_individuals(df, base_threshold=600_000, split_prob=0.7, rng_seed=42):
     rng = np.random.default_rng(rng_seed)
-    df = df.copy()
-
-    if "Original_ID" not in df.columns:
-        df["Original_ID"] = df.index
-    if "Household_Size" not in df.columns:
-        df["Household_Size"] = 1
-    if "Weight" not in df.columns:
-        df["Weight"] = 1.0
-
-    df["Split"] = (df["Net_Wealth"] > base_threshold) & (rng.random(len(df)) < split_prob)
-    df["n_units"] = np.where(df["Split"], 2, 1)
-
-    repeated_df = df.loc[df.index.repeat(df["n_units"])].copy()
-    repeated_df["Unit_Index"] = repeated_df.groupby("Original_ID").cumcount()
-
-    ratios = []
-    for units in df["n_units"]:
-        if units == 2:
-            if rng.random() < 0.5:
-                ratios.extend([0.8, 0.2])
-            else:
-                ratios.extend([0.9, 0.1])
-        else:
-            ratios.append(1.0)
 
-    # Now assign it — this must match exactly in length
-    ratios = np.array(ratios)
-    if len(ratios) != len(repeated_df):
-        raise ValueError("Mismatch between generated ratios and repeated_df length!")
+    split = (df["Net_Wealth"].to_numpy() > base_threshold) & (rng.random(len(df)) < split_prob)
+    n_units = np.where(split, 2, 1)
+    offsets = np.cumsum(n_units) - n_units
+
+    # Row selection builds a new frame, so the caller's df is left untouched
+    repeated_df = df.take(np.repeat(np.arange(len(df)), n_units))
+    if "Original_ID" not in repeated_df.columns:
+        repeated_df["Original_ID"] = repeated_df.index
+    if "Household_Size" not in repeated_df.columns:
+        repeated_df["Household_Size"] = 1
+    if "Weight" not in repeated_df.columns:
+        repeated_df["Weight"] = 1.0
 
-    repeated_df["Ratio"] = ratios
+    # Split households occupy two consecutive rows of repeated_df starting at their offset
+    split_offsets = offsets[split]
+    pick = rng.random(split_offsets.size) < 0.5
+
+    ratios = np.ones(len(repeated_df))
+    ratios[split_offsets] = np.where(pick, 0.8, 0.9)
+    ratios[split_offsets + 1] = np.where(pick, 0.2, 0.1)
 
     monetary_cols = [
         "Total_Assets", "Debts", "Real_Assets", "Financial_Assets",
@@ -350,13 +458,13 @@ def expand_households_to_individuals(df, base_threshold=600_000, split_prob=0.7,
     ]
     for col in monetary_cols:
         if col in repeated_df.columns:
-            repeated_df[col] *= repeated_df["Ratio"]
+            repeated_df[col] *= ratios
 
-    repeated_df["Weight"] *= repeated_df["Ratio"]
-    repeated_df["Tax_Unit_ID"] = repeated_df["Unit_Index"] + 1
+    repeated_df["Weight"] *= ratios
+    repeated_df["Tax_Unit_ID"] = np.arange(len(repeated_df)) - np.repeat(offsets, n_units) + 1
     repeated_df["Split_From"] = repeated_df["Original_ID"]
 
-    return repeated_df.drop(columns=["n_units", "Unit_Index", "Ratio", "Split"])
+    return repeated_df
 
 
 def assign_wealth_ranks_balanced_by_region(regions, rng_seed=42):
@@ -370,18 +478,21 @@ def assign_wealth_ranks_balanced_by_region(regions, rng_seed=42):
     Returns:
         np.ndarray: Array of wealth ranks in [0, 1], same length as `regions`.
     """
-    regions = np.array(regions)
-    unique_regions = np.unique(regions)
-    ranks = np.empty(len(regions))
+    regions = np.asarray(regions)
+    n = len(regions)
+    codes, _ = pd.factorize(regions)
+    counts = np.bincount(codes)
 
     rng = np.random.default_rng(rng_seed)
 
-    for region in unique_regions:
-        mask = (regions == region)
-        n = mask.sum()
-        region_ranks = np.linspace(0.0001, 1.0, n)
-        rng.shuffle(region_ranks)  # Shuffle within region
-        ranks[mask] = region_ranks
+    # Order rows by region, shuffled within region by a random permutation key
+    order = np.lexsort((rng.permutation(n), codes))
+    within = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+    group_size = counts[codes[order]]
+
+    # Evenly spaced ranks in [0.0001, 1.0] within each region (a grouped linspace)
+    ranks = np.empty(n)
+    ranks[order] = 0.0001 + within * (1.0 - 0.0001) / np.maximum(group_size - 1, 1)
 
     return ranks
 
@@ -395,12 +506,12 @@ def generate_and_adjust_households(stats_by_group, region_weights, income_data_f
     categories = pd.cut(
         wealth_ranks,
         bins=[0, 0.25, 0.50, 0.75, 0.9, 1.0],
-        labels=["under 25", "between 25 and 50", "between 50 and 75", "between 75 and 90", "between 90 and 100"],
+        labels=WEALTH_CATEGORIES,
         include_lowest=True
-    ).astype(str)
+    )
 
     df = pd.DataFrame({
-        "Region": regions,
+        "Region": pd.Categorical(regions),
         "Wealth_Rank": wealth_ranks,
         "Category": categories,
         "Household_Size": household_sizes
@@ -408,22 +519,27 @@ def generate_and_adjust_households(stats_by_group, region_weights, income_data_f
 
     # 🛠 FORCE each region to have some wealthy households
     rng = np.random.default_rng(42)
-    for region in df["Region"].unique():
-        idxs = df[df["Region"] == region].sample(n=min(5, len(df[df["Region"] == region])), random_state=42).index
-        df.loc[idxs, "Wealth_Rank"] = rng.uniform(0.95, 1.0, size=len(idxs))
-        df.loc[idxs, "Category"] = "between 90 and 100"
+    codes = df["Region"].cat.codes.to_numpy()
+    region_rows = np.split(np.argsort(codes, kind="stable"), np.cumsum(np.bincount(codes))[:-1])
+    idxs = np.concatenate([rng.choice(rows, size=min(5, rows.size), replace=False) for rows in region_rows])
+    df.loc[idxs, "Wealth_Rank"] = rng.uniform(0.95, 1.0, size=idxs.size)
+    df.loc[idxs, "Category"] = "between 90 and 100"
 
     # 2. Merge stats + noise
-    df = df.merge(stats_by_group, on="Category", how="left")
+    stats_dtypes = {"Category": WEALTH_CATEGORY_DTYPE}
+    stats_dtypes.update({col: np.float32 for col in ASSET_RATIO_COLUMNS if col in stats_by_group.columns})
+    df = df.merge(stats_by_group.astype(stats_dtypes), on="Category", how="left")
     df.dropna(subset=["Total_Assets"], inplace=True)
-    np.random.seed(42)
-    df["Total_Assets"] *= np.random.normal(1.0, 0.05, len(df))
-
-    mid_mask = (df["Wealth_Rank"] > 0.3) & (df["Wealth_Rank"] <= 0.9)
-    df.loc[mid_mask, "Total_Assets"] *= np.random.normal(1.0, 0.15, mid_mask.sum())
-
-    bot_mask = df["Wealth_Rank"] <= 0.5
-    df.loc[bot_mask, "Total_Assets"] *= np.random.normal(1.2, 0.25, bot_mask.sum())
+    # One bulk draw for the three multiplicative noise layers: N(1, 0.05) for everyone,
+    # N(1, 0.15) on the middle ranks and N(1.2, 0.25) on the bottom half
+    wr = df["Wealth_Rank"].to_numpy()
+    mid_mask = (wr > 0.3) & (wr <= 0.9)
+    bot_mask = wr <= 0.5
+    z = rng.standard_normal((3, len(df)))
+    noise = 1.0 + 0.05 * z[0]
+    noise *= np.where(mid_mask, 1.0 + 0.15 * z[1], 1.0)
+    noise *= np.where(bot_mask, 1.2 + 0.25 * z[2], 1.0)
+    df["Total_Assets"] *= noise
 
     # 3. Construct other components
     df["Business_Assets"] = df.get("Business_Assets", 0.0)
@@ -444,8 +560,10 @@ def generate_and_adjust_households(stats_by_group, region_weights, income_data_f
                               (income_data["estadistico"].str.upper() == "MEAN") &
                               (income_data["wave"] == 2022)]
     income_map = dict(zip(income_data["category"].str.strip().str.lower(), income_data["value"] * 1000))
-    df["Income"] = df["Category"].map(lambda cat: np.random.normal(
-        max(1, income_map.get(cat, 0)), 0.05 * max(1, income_map.get(cat, 0))))
+    # Mean income per category code; the trailing entry serves code -1 (category not in EFF groups)
+    mu_by_code = np.array([max(1, income_map.get(cat, 0)) for cat in WEALTH_CATEGORIES] + [1.0])
+    codes = df["Category"].cat.codes.to_numpy()
+    df["Income"] = rng.normal(mu_by_code[codes], 0.05 * mu_by_code[codes])
 
     df["Original_ID"] = df.index
 
@@ -455,21 +573,32 @@ def generate_and_adjust_households(stats_by_group, region_weights, income_data_f
     return df_individuals, df[["Original_ID", "Household_Size"]]
 
 def assign_declarant_weights(df):
-    df = df.copy()
     df["Declarant_Weight"] = df.get("Weight", 1.0)
     return df
 
+LOW_EXEMPTION_REGIONS = ("catalonia", "extremadura", "valencia")
+
 def get_personal_exemption(region):
-    return 500_000 if region in ["catalonia", "extremadura", "valencia"] else 700_000
+    return 500_000 if region in LOW_EXEMPTION_REGIONS else 700_000
+
+def get_personal_exemption_vec(regions):
+    # Integer euros, same as the scalar version (keeps Personal_Exemption int64 in the export)
+    if isinstance(getattr(regions, "dtype", None), pd.CategoricalDtype):
+        # Resolve once per category and gather by code; the trailing entry serves
+        # code -1 (missing label), which is not a low-exemption region
+        regions = pd.Categorical(regions)
+        by_category = np.append(get_personal_exemption_vec(regions.categories.to_numpy()), 700_000)
+        return by_category[regions.codes]
+    return np.where(np.isin(np.asarray(regions), LOW_EXEMPTION_REGIONS), 500_000, 700_000).astype(np.int64)
 
 def compute_total_exemption(row):
     personal_exemption = get_personal_exemption(row["Region"])
     primary_exempt = min(row.get("Adj_Real_Assets", 0), 300_000)
     return personal_exemption + primary_exempt + row.get("Business_Exemption", 0.0)
 
-def assign_erosion(df, max_erosion=0.40, base_dropouts=True, verbose=False):
-
-    df = df.copy()
+def assign_erosion(df, max_erosion=0.40, base_dropouts=True, verbose=False, rng_seed=42, rng=None):
+    # Pass `rng` (a np.random.Generator) to draw dropouts from the caller's stream;
+    # otherwise a fresh generator is seeded with `rng_seed`
 
     # Base erosion by wealth percentile
     base_erosion = np.select(
@@ -501,7 +630,9 @@ def assign_erosion(df, max_erosion=0.40, base_dropouts=True, verbose=False):
             )
         )
         df["Dropout_Prob"] = dropout_prob
-        df["Dropout"] = np.random.binomial(1, dropout_prob)
+        # Bernoulli draw: a uniform compared against p, rather than the general binomial sampler
+        rng = rng if rng is not None else np.random.default_rng(rng_seed)
+        df["Dropout"] = (rng.random(len(df)) < dropout_prob).astype(np.int8)
     else:
         df["Dropout_Prob"] = 0.0
         df["Dropout"] = 0
@@ -515,29 +646,25 @@ def assign_erosion(df, max_erosion=0.40, base_dropouts=True, verbose=False):
 
 def apply_migration_module(df, thresholds=None, base_probs=None, max_ratio_bump=0.01, verbose=False):
 
-    df = df.copy()
-
     # Default thresholds and probabilities
     thresholds = thresholds or {"top_01": 0.999, "top_1": 0.99, "top_5": 0.95}
     base_probs = base_probs or {"top_01": 0.010, "top_1": 0.005, "top_5": 0.002}
 
-    def compute_prob(row):
-        wealth_rank = row.get("Wealth_Rank", 0)
-        prob = 0.0
-        if wealth_rank > thresholds["top_01"]:
-            prob = base_probs["top_01"]
-        elif wealth_rank > thresholds["top_1"]:
-            prob = base_probs["top_1"]
-        elif wealth_rank > thresholds["top_5"]:
-            prob = base_probs["top_5"]
-
-        if "Wealth_Tax_Baseline" in row and "Adj_Net_Wealth" in row:
-            ratio = row["Wealth_Tax_Baseline"] / (row["Adj_Net_Wealth"] + 1e-6)
-            prob *= 1 + min(ratio, max_ratio_bump)
+    wr = df["Wealth_Rank"].to_numpy() if "Wealth_Rank" in df.columns else np.zeros(len(df))
+    prob = np.select(
+        [wr > thresholds["top_01"], wr > thresholds["top_1"], wr > thresholds["top_5"]],
+        [base_probs["top_01"], base_probs["top_1"], base_probs["top_5"]],
+        default=0.0
+    )
 
-        return min(prob, 1.0)
+    if "Wealth_Tax_Baseline" in df.columns and "Adj_Net_Wealth" in df.columns:
+        ratio = np.minimum(
+            df["Wealth_Tax_Baseline"].to_numpy() / (df["Adj_Net_Wealth"].to_numpy() + 1e-6), max_ratio_bump
+        )
+        prob *= 1 + ratio
 
-    df["Migration_Prob"] = df.apply(compute_prob, axis=1)
+    np.minimum(prob, 1.0, out=prob)
+    df["Migration_Prob"] = prob
     df["Migration_Exit"] = np.random.rand(len(df)) < df["Migration_Prob"]
 
     df.loc[df["Migration_Exit"], "Taxable_Wealth_Eroded"] = 0.0
@@ -560,32 +687,55 @@ def generate_tax_diagnostics(df):
         print(f"{k}: {v:,.2f}")
     return diagnostics
 
-def calculate_ip_tax(base, region="default"):
-    regional_scales = {
-        "Catalonia": [(0, 167129.45, 0.0021), (167129.45, 334252.88, 0.00315), (334252.88, 668499.75, 0.00525),
-                      (668499.75, 1336999.5, 0.00945), (1336999.5, 2673999.0, 0.01365), (2673999.0, 5347998.03, 0.01785),
-                      (5347998.03, 10695996.06, 0.02205), (10695996.06, 19999999.99, 0.02525), (19999999.99, float("inf"), 0.0348)],
-        "Madrid": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
-                   (668499.75, 1336999.5, 0.009), (1336999.5, 2673999.0, 0.013), (2673999.0, 5347998.03, 0.017),
-                   (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.025)],
-        "Extremadura": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
-                        (668499.75, 1336999.5, 0.009), (1336999.5, 2673999.0, 0.013), (2673999.0, 5347998.03, 0.017),
-                        (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.0375)],
-        "Galicia": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
+IP_TAX_SCALES = {
+    "Catalonia": [(0, 167129.45, 0.0021), (167129.45, 334252.88, 0.00315), (334252.88, 668499.75, 0.00525),
+                  (668499.75, 1336999.5, 0.00945), (1336999.5, 2673999.0, 0.01365), (2673999.0, 5347998.03, 0.01785),
+                  (5347998.03, 10695996.06, 0.02205), (10695996.06, 19999999.99, 0.02525), (19999999.99, float("inf"), 0.0348)],
+    "Madrid": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
+               (668499.75, 1336999.5, 0.009), (1336999.5, 2673999.0, 0.013), (2673999.0, 5347998.03, 0.017),
+               (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.025)],
+    "Extremadura": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
                     (668499.75, 1336999.5, 0.009), (1336999.5, 2673999.0, 0.013), (2673999.0, 5347998.03, 0.017),
-                    (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.035)],
-        "Asturias": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
-                     (668499.75, 1336999.5, 0.009), (1336999.5, 2673999.0, 0.013), (2673999.0, 5347998.03, 0.017),
-                     (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.025)],
-        "Valencia": [(0, 167129.45, 0.0025), (167129.45, 334252.88, 0.0035), (334252.88, 668499.75, 0.0055),
-                     (668499.75, 1336999.5, 0.0095), (1336999.5, 2673999.0, 0.0135), (2673999.0, 5347998.03, 0.0175),
-                     (5347998.03, 10695996.06, 0.0215), (10695996.06, float("inf"), 0.035)],
-        "default": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
-                    (668499.75, 1336999.51, 0.009), (1336999.51, 2673999.01, 0.013), (2673999.01, 5347998.03, 0.017),
-                    (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.025)]
-    }
+                    (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.0375)],
+    "Galicia": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
+                (668499.75, 1336999.5, 0.009), (1336999.5, 2673999.0, 0.013), (2673999.0, 5347998.03, 0.017),
+                (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.035)],
+    "Asturias": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
+                 (668499.75, 1336999.5, 0.009), (1336999.5, 2673999.0, 0.013), (2673999.0, 5347998.03, 0.017),
+                 (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.025)],
+    "Valencia": [(0, 167129.45, 0.0025), (167129.45, 334252.88, 0.0035), (334252.88, 668499.75, 0.0055),
+                 (668499.75, 1336999.5, 0.0095), (1336999.5, 2673999.0, 0.0135), (2673999.0, 5347998.03, 0.0175),
+                 (5347998.03, 10695996.06, 0.0215), (10695996.06, float("inf"), 0.035)],
+    "default": [(0, 167129.45, 0.002), (167129.45, 334252.88, 0.003), (334252.88, 668499.75, 0.005),
+                (668499.75, 1336999.51, 0.009), (1336999.51, 2673999.01, 0.013), (2673999.01, 5347998.03, 0.017),
+                (5347998.03, 10695996.06, 0.021), (10695996.06, float("inf"), 0.025)]
+}
+
 
-    brackets = regional_scales.get(region, regional_scales["default"])
+def _pack_ip_tax_scales(scales):
+    """
+    Pack the bracket schedules into (n_regions, n_brackets) arrays of lower bounds,
+    marginal rates and cumulative tax at each lower bound. Shorter schedules are
+    padded with +inf lower bounds so the padding is never reached.
+    """
+    n_brackets = max(len(b) for b in scales.values())
+    lower = np.full((len(scales), n_brackets), np.inf)
+    rate = np.zeros((len(scales), n_brackets))
+    cum_tax = np.zeros((len(scales), n_brackets))
+    for r, brackets in enumerate(scales.values()):
+        lo, up, rt = (np.array(c, dtype=np.float64) for c in zip(*brackets))
+        lower[r, :len(brackets)] = lo
+        rate[r, :len(brackets)] = rt
+        cum_tax[r, 1:len(brackets)] = np.cumsum((up - lo) * rt)[:-1]
+    return lower, rate, cum_tax
+
+
+IP_TAX_REGIONS = list(IP_TAX_SCALES)
+_IP_LOWER, _IP_RATE, _IP_CUM_TAX = _pack_ip_tax_scales(IP_TAX_SCALES)
+
+
+def calculate_ip_tax(base, region="default"):
+    brackets = IP_TAX_SCALES.get(region, IP_TAX_SCALES["default"])
     tax = 0.0
 
     for lower, upper, rate in brackets:
@@ -598,50 +748,112 @@ def calculate_ip_tax(base, region="default"):
     return tax
 
 
+def ip_tax_region_index(region, n):
+    """
+    Row of the packed bracket tables for each of `n` rows, given one region label or an
+    array of labels. Unknown labels map to the default schedule, as in calculate_ip_tax.
+    A single label, or categorical labels, are resolved once rather than once per row.
+    """
+    if isinstance(region, str):
+        schedule = region if region in IP_TAX_SCALES else "default"
+        return np.full(n, IP_TAX_REGIONS.index(schedule), dtype=np.intp)
+    if isinstance(getattr(region, "dtype", None), pd.CategoricalDtype):
+        categories = region.cat.categories if isinstance(region, pd.Series) else region.categories
+        codes = region.cat.codes.to_numpy() if isinstance(region, pd.Series) else region.codes
+        # Trailing entry catches code -1 (missing label) -> default schedule
+        by_category = np.append(ip_tax_region_index(categories.to_numpy(), len(categories)),
+                                IP_TAX_REGIONS.index("default"))
+        return by_category[codes]
+    region_idx = pd.Categorical(np.broadcast_to(region, (n,)), categories=IP_TAX_REGIONS).codes
+    return np.where(region_idx < 0, IP_TAX_REGIONS.index("default"), region_idx)
+
+
+def calculate_ip_tax_vec(base, region="default", region_idx=None):
+    """
+    Array version of calculate_ip_tax: `base` is an array of taxable wealth and
+    `region` either a single region label or an array/Series of labels (one per row).
+    Pass `region_idx` from ip_tax_region_index to reuse the label lookup across calls.
+    """
+    base = np.asarray(base, dtype=np.float64)
+    if region_idx is None:
+        region_idx = ip_tax_region_index(region, base.size)
+
+    # Dispatch on the (few) schedules: bracket k applies when base > lower[k]
+    k = np.empty(base.size, dtype=np.intp)
+    for r in np.flatnonzero(np.bincount(region_idx, minlength=len(IP_TAX_REGIONS))):
+        rows = np.flatnonzero(region_idx == r)
+        k[rows] = np.searchsorted(_IP_LOWER[r], base[rows], side="left") - 1
+    k = np.clip(k, 0, _IP_LOWER.shape[1] - 1)
+
+    tax = _IP_CUM_TAX[region_idx, k] + (base - _IP_LOWER[region_idx, k]) * _IP_RATE[region_idx, k]
+    return np.where(base > 0, tax, 0.0)
+
+
 def simulate_pit(incomes):
     brackets = np.array([12450, 20200, 35200, 60000, 300000, np.inf])
     rates = np.array([0.19, 0.24, 0.30, 0.37, 0.45, 0.47])
 
     taxes = np.zeros_like(incomes, dtype=np.float64)
+    # With only six brackets, a fused sweep beats a per-row bracket lookup;
+    # one scratch buffer is reused across brackets
+    taxable = np.empty_like(taxes)
     last_limit = 0.0
 
     for limit, rate in zip(brackets, rates):
-        taxable = np.minimum(incomes, limit) - last_limit
-        taxable = np.maximum(taxable, 0)
-        taxes += taxable * rate
+        np.minimum(incomes, limit, out=taxable)
+        taxable -= last_limit
+        np.maximum(taxable, 0, out=taxable)
+        taxable *= rate
+        taxes += taxable
         last_limit = limit
 
     return taxes
 
+def _cap_wealth_tax(wealth_tax, pit, cap):
+    """Joint IP + IRPF limit: above the cap, wealth tax is cut to cap - PIT but never below 20%."""
+    return np.where(wealth_tax + pit > cap, np.maximum(0.2 * wealth_tax, cap - pit), wealth_tax)
+
 def apply_tax_cap_and_adjustments(df):
-    df = df.copy()
-    df["Cap"] = 0.60 * df["Income"]
-    over_limit = df["Wealth_Tax"] + df["PIT_Liability"] > df["Cap"]
-    df.loc[over_limit, "Wealth_Tax"] = np.maximum(
-        0.2 * df.loc[over_limit, "Wealth_Tax"],
-        df.loc[over_limit, "Cap"] - df.loc[over_limit, "PIT_Liability"]
-    )
-    df["Weighted_Wealth_Tax"] = df["Wealth_Tax"] * df["Declarant_Weight"]
+    cap = 0.60 * df["Income"].to_numpy()
+    wealth_tax = _cap_wealth_tax(df["Wealth_Tax"].to_numpy(), df["PIT_Liability"].to_numpy(), cap)
+    df["Cap"] = cap
+    df["Wealth_Tax"] = wealth_tax
+    df["Weighted_Wealth_Tax"] = wealth_tax * df["Declarant_Weight"].to_numpy()
     return df
 
-def run_tax_simulation(df, biz_prob=1):
-    df = df.copy()
-
-    df["Region_Scale"] = df["Region"].map(region_scaling).fillna(1.0)
+def run_tax_simulation(df, biz_prob=1, rng=None):
+    df["Region_Scale"] = df["Region"].map(region_scaling).astype(np.float64).fillna(1.0)
     if "Total_Assets_Pareto" in df.columns:
         df["Total_Assets"] = df["Total_Assets_Pareto"]
 
-    df["Debts"] = df["Total_Assets"] * df["Debt_Ratio"]
-    df["Net_Wealth"] = df["Total_Assets"] - df["Debts"]
-    df["Real_Assets"] = df["Total_Assets"] * df["Real_Asset_Ratio"]
-    df["Financial_Assets"] = df["Total_Assets"] * df["Financial_Asset_Ratio"]
-    df["Business_Assets"] = df["Total_Assets"] * df["Business_Asset_Ratio"]
-
-    df["Adj_Real_Assets"] = df["Real_Assets"] * 0.75
-    df["Adj_Financial_Assets"] = df["Financial_Assets"]
-    df["Adj_Business_Assets"] = df["Business_Assets"] * 0.70
-    df["Adj_Total_Assets"] = df["Adj_Real_Assets"] + df["Adj_Financial_Assets"] + df["Adj_Business_Assets"]
-    df["Adj_Net_Wealth"] = df["Adj_Total_Assets"] - df["Debts"]
+    # Derive the whole asset/debt breakdown from the input arrays in one block,
+    # including the business reclassification, and write each column once
+    ta = df["Total_Assets"].to_numpy()
+    biz_ratio = df["Business_Asset_Ratio"].to_numpy()
+    debts = ta * df["Debt_Ratio"].to_numpy()
+    real = ta * df["Real_Asset_Ratio"].to_numpy()
+    fin = ta * df["Financial_Asset_Ratio"].to_numpy()
+    biz = ta * biz_ratio
+    adj_real = real * 0.75
+    adj_biz_gross = biz * 0.70
+    reclass = np.where(biz_ratio > 0.2, adj_biz_gross * 0.2, 0.0)
+    adj_biz = adj_biz_gross - reclass
+    adj_total = adj_real + fin + adj_biz
+
+    derived = {
+        "Debts": debts,
+        "Net_Wealth": ta - debts,
+        "Real_Assets": real,
+        "Financial_Assets": fin,
+        "Business_Assets": biz,
+        "Adj_Real_Assets": adj_real,
+        "Adj_Financial_Assets": fin.copy(),
+        "Adj_Business_Assets": adj_biz,
+        "Adj_Total_Assets": adj_total,
+        "Adj_Net_Wealth": adj_total - debts,
+    }
+    for col, values in derived.items():
+        df[col] = values
 
     df["Business_Exemption"] = 0.0
     eligible = (
@@ -651,18 +863,9 @@ def run_tax_simulation(df, biz_prob=1):
     print(df["Business_Asset_Ratio"].describe())
     print(f"Eligible for exemption: {(eligible.sum())} / {len(df)}")
 
-    exemption_map = {
-        "catalonia": 500_000, "extremadura": 500_000, "valencia": 500_000,
-        "asturias": 700_000, "galicia": 700_000, "madrid": 700_000
-    }
-    df["Personal_Exemption"] = df["Region"].map(exemption_map).fillna(700_000)
+    df["Personal_Exemption"] = get_personal_exemption_vec(df["Region"])
 
-    reclass_mask = df["Business_Asset_Ratio"] > 0.2
-    df["Business_Reclass"] = 0.0
-    df.loc[reclass_mask, "Business_Reclass"] = df.loc[reclass_mask, "Adj_Business_Assets"] * 0.2
-    df["Adj_Business_Assets"] -= df["Business_Reclass"]
-    df["Adj_Total_Assets"] = df["Adj_Real_Assets"] + df["Adj_Financial_Assets"] + df["Adj_Business_Assets"]
-    df["Adj_Net_Wealth"] = df["Adj_Total_Assets"] - df["Debts"]
+    df["Business_Reclass"] = reclass
 
     df["Gross_Tax_Base"] = df["Adj_Net_Wealth"] - df["Primary_Residence_Exempt"] - df["Business_Exemption"]
     df["Net_Tax_Base"] = (df["Gross_Tax_Base"] - df["Personal_Exemption"]).clip(lower=0)
@@ -670,48 +873,53 @@ def run_tax_simulation(df, biz_prob=1):
     df["Is_Declarant"] = (df["Net_Tax_Base"] > 0) | (df["Gross_Assets"] > 2_000_000)
     df["Is_Taxpayer"] = df["Is_Declarant"]
 
-    df = assign_erosion(df)
-
-    df["Liquid_Heavy"] = df["Financial_Asset_Ratio"] > 0.4
-    df.loc[df["Liquid_Heavy"], "Income"] *= 0.95
-    df["Business_High"] = df["Business_Asset_Ratio"] > 0.2
-    df["Business_Low"] = ~df["Business_High"]
-    df.loc[df["Business_High"], "Erosion_Factor"] *= 1.05
-    df.loc[df["Business_Low"], "Erosion_Factor"] *= 1.10
-    df["Erosion_Factor"] = df["Erosion_Factor"].clip(upper=0.3)
-
-    df["Taxable_Wealth"] = (
-        df["Adj_Net_Wealth"] - df["Personal_Exemption"] - df["Primary_Residence_Exempt"] - df["Business_Exemption"]
-    ).clip(lower=0)
-    df["Taxable_Wealth_Baseline"] = df["Taxable_Wealth"]
-    df["Taxable_Wealth_Eroded"] = df["Taxable_Wealth"] * (1 - df["Erosion_Factor"])
-
-    df["Wealth_Tax"] = df.apply(lambda row: calculate_ip_tax(row["Taxable_Wealth_Eroded"], row["Region"]), axis=1)
-    df.loc[df["Dropout"] > 0, "Wealth_Tax"] = 0
-
-    df["PIT_Liability"] = simulate_pit(df["Income"].values)
-    df["Cap"] = 0.60 * df["Income"]
-    over_limit = df["Wealth_Tax"] + df["PIT_Liability"] > df["Cap"]
-    df.loc[over_limit, "Wealth_Tax"] = np.maximum(
-        0.2 * df.loc[over_limit, "Wealth_Tax"],
-        df.loc[over_limit, "Cap"] - df.loc[over_limit, "PIT_Liability"]
+    df = assign_erosion(df, rng=rng)
+
+    # Behavioural adjustments, tax base and wealth tax as one pass over plain
+    # arrays; each result column is written to the frame once
+    liquid_heavy = df["Financial_Asset_Ratio"].to_numpy() > 0.4
+    business_high = biz_ratio > 0.2
+    income = df["Income"].to_numpy() * np.where(liquid_heavy, 0.95, 1.0)
+    erosion = np.minimum(df["Erosion_Factor"].to_numpy() * np.where(business_high, 1.05, 1.10), 0.3)
+    taxable = np.maximum(
+        df["Adj_Net_Wealth"].to_numpy() - df["Personal_Exemption"].to_numpy()
+        - df["Primary_Residence_Exempt"].to_numpy() - df["Business_Exemption"].to_numpy(),
+        0.0,
     )
+    taxable_eroded = taxable * (1 - erosion)
+
+    df["Liquid_Heavy"] = liquid_heavy
+    df["Income"] = income
+    df["Business_High"] = business_high
+    df["Business_Low"] = ~business_high
+    df["Erosion_Factor"] = erosion
+    df["Taxable_Wealth"] = taxable
+    df["Taxable_Wealth_Baseline"] = taxable.copy()
+    df["Taxable_Wealth_Eroded"] = taxable_eroded
+
+    # Dropouts pay nothing; the joint IP + IRPF cap then applies to the rest
+    wealth_tax = np.where(df["Dropout"].to_numpy() > 0, 0.0, calculate_ip_tax_vec(taxable_eroded, df["Region"]))
+    pit = simulate_pit(income)
+    cap = 0.60 * income
+
+    df["Wealth_Tax"] = _cap_wealth_tax(wealth_tax, pit, cap)
+    df["PIT_Liability"] = pit
+    df["Cap"] = cap
 
     return df
 
 def apply_baseline_behavioral_erosion(df: pd.DataFrame, verbose=False):
 
-    df = df.copy()
     assert "Erosion_Factor" in df.columns, "Erosion_Factor must be computed before applying behavioral erosion"
 
-    # Apply erosion
-    df["Taxable_Wealth_Baseline_Eroded"] = df["Taxable_Wealth_Baseline"] * (1 - df["Erosion_Factor"])
-    df["Wealth_Tax_Baseline_Eroded"] = df.apply(
-        lambda row: calculate_ip_tax(row["Taxable_Wealth_Baseline_Eroded"], row["Region"]), axis=1
-    )
-    df["Weighted_Wealth_Tax_Baseline_Eroded"] = (
-        df["Wealth_Tax_Baseline_Eroded"] * df["Final_Weight"]
-    )
+    # Apply erosion. This is not the same as run_tax_simulation's Taxable_Wealth_Eroded:
+    # main re-draws Erosion_Factor (assign_erosion with its own cap) after the tax run,
+    # and migrants have Taxable_Wealth_Eroded zeroed, so the base must be recomputed.
+    taxable_eroded = df["Taxable_Wealth_Baseline"].to_numpy() * (1 - df["Erosion_Factor"].to_numpy())
+    wealth_tax_eroded = calculate_ip_tax_vec(taxable_eroded, df["Region"])
+    df["Taxable_Wealth_Baseline_Eroded"] = taxable_eroded
+    df["Wealth_Tax_Baseline_Eroded"] = wealth_tax_eroded
+    df["Weighted_Wealth_Tax_Baseline_Eroded"] = wealth_tax_eroded * df["Final_Weight"].to_numpy()
 
     # Compute summary
     baseline_total = (df["Wealth_Tax_Baseline"] * df["Final_Weight"]).sum() if "Wealth_Tax_Baseline" in df.columns else None
@@ -744,9 +952,6 @@ region_scaling = {
 
 def apply_region_multipliers(df, multipliers, recompute=True):
 
-    df = df.copy()
-    all_regions = df["Region"].unique()
-
     # Validation for required ratio columns
     required_ratios = ["Debt_Ratio", "Real_Asset_Ratio", "Financial_Asset_Ratio"]
     for col in required_ratios:
@@ -755,29 +960,31 @@ def apply_region_multipliers(df, multipliers, recompute=True):
         if df[col].isna().any():
             raise ValueError(f"Column '{col}' contains NaN values")
 
-    for region in all_regions:
+    for region in df["Region"].unique():
         if region not in multipliers:
             print(f" Warning: No scaling multiplier found for region '{region}'. Using default factor 1.0.")
-        factor = multipliers.get(region, 1.0)
-        mask = df["Region"] == region
-
-        # Scale total assets
-        df.loc[mask, "Total_Assets"] *= factor
-
-        if recompute:
-            # Recompute dependent fields
-            df.loc[mask, "Debts"] = df.loc[mask, "Total_Assets"] * df.loc[mask, "Debt_Ratio"]
-            df.loc[mask, "Net_Wealth"] = df.loc[mask, "Total_Assets"] - df.loc[mask, "Debts"]
-            df.loc[mask, "Real_Assets"] = df.loc[mask, "Total_Assets"] * df.loc[mask, "Real_Asset_Ratio"]
-            df.loc[mask, "Financial_Assets"] = df.loc[mask, "Total_Assets"] * df.loc[mask, "Financial_Asset_Ratio"]
-
-            if "Business_Asset_Ratio" in df.columns:
-                if df.loc[mask, "Business_Asset_Ratio"].isna().any():
-                    print(f"⚠️ Warning: NaN values in 'Business_Asset_Ratio' for region '{region}'")
-                df.loc[mask, "Business_Assets"] = df.loc[mask, "Total_Assets"] * df.loc[mask, "Business_Asset_Ratio"]
-            else:
-                print(f"ℹ️ Info: 'Business_Asset_Ratio' not found. Setting Business_Assets to 0 for region '{region}'")
-                df.loc[mask, "Business_Assets"] = 0.0
+    factor = df["Region"].map(multipliers).astype(np.float64).fillna(1.0).to_numpy()
+
+    # Scale total assets
+    total_assets = df["Total_Assets"].to_numpy() * factor
+    df["Total_Assets"] = total_assets
+
+    if recompute:
+        # Recompute dependent fields
+        debts = total_assets * df["Debt_Ratio"].to_numpy()
+        df["Debts"] = debts
+        df["Net_Wealth"] = total_assets - debts
+        df["Real_Assets"] = total_assets * df["Real_Asset_Ratio"].to_numpy()
+        df["Financial_Assets"] = total_assets * df["Financial_Asset_Ratio"].to_numpy()
+
+        if "Business_Asset_Ratio" in df.columns:
+            business_ratio = df["Business_Asset_Ratio"]
+            for region in df.loc[business_ratio.isna(), "Region"].unique():
+                print(f"⚠️ Warning: NaN values in 'Business_Asset_Ratio' for region '{region}'")
+            df["Business_Assets"] = total_assets * business_ratio.to_numpy()
+        else:
+            print("ℹ️ Info: 'Business_Asset_Ratio' not found. Setting Business_Assets to 0")
+            df["Business_Assets"] = 0.0
 
     df.reset_index(drop=True, inplace=True)
     print("\n✅ Region multipliers applied. Preview of updated DataFrame:")
@@ -785,63 +992,43 @@ def apply_region_multipliers(df, multipliers, recompute=True):
     return df
 
 def scale_final_weights_by_taxpayer_counts(df, region_targets_quota):
-    df = df.copy()
-    df["Region"] = df["Region"].str.strip().str.lower()
-
-    df["Scaled_Taxpayer_Weight"] = df["Final_Weight"]  # start by preserving existing weight
-
-    for region, target_count in region_targets_quota.items():
-        mask = (df["Region"] == region) & (df["Is_Taxpayer"] == 1)
-        regional_declarants = df[mask]
+    # Quota keys are lowercase region names; normalizing the categories is O(#regions)
+    df["Region"] = normalize_region_categories(df["Region"])
+    is_taxpayer = (df["Is_Taxpayer"] == 1).to_numpy()
+    simulated_weight = (
+        df.loc[is_taxpayer, "Final_Weight"].groupby(df.loc[is_taxpayer, "Region"], observed=True).sum()
+    )
 
-        if regional_declarants.empty:
+    for region in region_targets_quota:
+        if region not in simulated_weight.index:
             print(f" No taxpayers found in region '{region}', skipping.")
-            continue
-
-        total_weight = regional_declarants["Final_Weight"].sum()
-        if total_weight == 0:
+        elif simulated_weight[region] == 0:
             print(f" Zero simulated taxpayer weight in region '{region}', skipping.")
-            continue
 
-        scaling_factor = target_count / total_weight
-        df.loc[mask, "Scaled_Taxpayer_Weight"] *= scaling_factor
+    # Target / simulated taxpayer weight per region; skipped regions keep factor 1.0
+    scaling = pd.Series(region_targets_quota, dtype=np.float64) / simulated_weight[simulated_weight != 0]
+    factor = df["Region"].map(scaling).astype(np.float64).to_numpy()
+    factor = np.where(is_taxpayer & ~np.isnan(factor), factor, 1.0)
 
-    # Set Final_Weight to this adjusted version
-    df["Final_Weight"] = df["Scaled_Taxpayer_Weight"]
-    df.drop(columns=["Scaled_Taxpayer_Weight"], inplace=True)
+    df["Final_Weight"] = df["Final_Weight"].to_numpy() * factor
 
     return df
 
 def compare_to_observed(households_df: pd.DataFrame) -> pd.DataFrame:
-    # Load and clean observed data
-    observed_df = pd.read_csv("Cleaned_Regional_Wealth_Tax_Data.csv")
-    observed_df["Region"] = observed_df["Region"].str.strip().str.lower()
-
-    # Filter only the "resultado de la declaración" rows
-    observed_clean = observed_df[
-        observed_df["Variable"].str.strip().str.lower() == "resultado de la declaración"
-    ].copy()
-
-    # Parse numeric values in Spanish format
-    observed_clean["Total_Revenue"] = (
-        observed_clean["Importe"]
-        .astype(str)
-        .str.replace(".", "", regex=False)
-        .str.replace(",", ".", regex=False)
-    )
-    observed_clean["Total_Revenue"] = pd.to_numeric(observed_clean["Total_Revenue"], errors="coerce")
-    observed_clean = observed_clean[["Region", "Total_Revenue"]]
+    observed_revenue = _load_observed()
+    observed_clean = observed_revenue.reset_index()
 
-    # Prepare simulated data
-    df = households_df.copy()
-    df["Region"] = df["Region"].str.strip().str.lower()
-    df_taxpayers = df[df["Is_Taxpayer"] == True].copy()
-    df_taxpayers["Weighted_Wealth_Tax"] = df_taxpayers["Wealth_Tax"] * df_taxpayers["Final_Weight"]
+    # Prepare simulated data (read-only: the caller's frame is not modified)
+    is_taxpayer = households_df["Is_Taxpayer"] == True
+    taxpayer_regions = normalize_region_categories(households_df.loc[is_taxpayer, "Region"])
+    weighted_wealth_tax = households_df.loc[is_taxpayer, "Wealth_Tax"] * households_df.loc[is_taxpayer, "Final_Weight"]
 
     simulated_revenue = (
-        df_taxpayers.groupby("Region", as_index=False)["Weighted_Wealth_Tax"]
+        weighted_wealth_tax.groupby(taxpayer_regions, observed=True)
         .sum()
-        .rename(columns={"Weighted_Wealth_Tax": "Simulated_Actual_Revenue"})
+        .rename("Simulated_Actual_Revenue")
+        .rename_axis("Region")
+        .reset_index()
     )
 
     # Merge and calculate % gap (handles missing observed values)
@@ -854,118 +1041,142 @@ def compare_to_observed(households_df: pd.DataFrame) -> pd.DataFrame:
         np.nan
     )
 
-    # Format for human-readable output
-    merged["Simulated_Actual_Revenue"] = merged["Simulated_Actual_Revenue"].map("${:,.0f}".format)
-    merged["Total_Revenue"] = merged["Total_Revenue"].map("${:,.0f}".format)
-    merged["Gap_%"] = merged["Gap_%"].map(lambda x: f"{x:.2f}%" if pd.notna(x) else "N/A")
-
     # Add total row
-    total_sim = df_taxpayers["Weighted_Wealth_Tax"].sum()
-    total_obs = observed_clean["Total_Revenue"].sum()
+    total_sim = weighted_wealth_tax.sum()
+    total_obs = observed_revenue.sum()
     total_gap_pct = (
         100 * (total_sim - total_obs) / total_obs if total_obs > 0 else np.nan
     )
     total_row = pd.DataFrame([{
         "Region": "TOTAL",
-        "Simulated_Actual_Revenue": "${:,.0f}".format(total_sim),
-        "Total_Revenue": "${:,.0f}".format(total_obs),
-        "Gap_%": f"{total_gap_pct:.2f}%" if pd.notna(total_gap_pct) else "N/A"
+        "Simulated_Actual_Revenue": total_sim,
+        "Total_Revenue": total_obs,
+        "Gap_%": total_gap_pct,
     }])
 
     result = pd.concat([merged, total_row], ignore_index=True)
 
-    # Print report
+    # Print report; the returned frame stays numeric, only the printout is formatted
     print("\n📊 Revenue Comparison with Observed:")
-    print(result.to_string(index=False))
+    print(result.to_string(index=False, na_rep="N/A", formatters={
+        "Simulated_Actual_Revenue": "${:,.0f}".format,
+        "Total_Revenue": "${:,.0f}".format,
+        "Gap_%": "{:.2f}%".format,
+    }))
     return result
-def generate_region_summary(df_region, region_name):
-    df_region = df_region.copy()
+def generate_region_summaries(df, region_idx=None):
+    """
+    One summary row per region: revenue with and without exemptions, and under the
+    national (Asturias) rule. Taxes are computed once for the whole frame and reduced
+    per region with bincount; regions appear in order of first occurrence.
+    Pass `region_idx` from ip_tax_region_index to reuse an existing schedule lookup.
+    """
+    adj_net_wealth = df["Adj_Net_Wealth"].to_numpy()
+    wealth_tax = df["Wealth_Tax"].to_numpy()
+    final_weight = df["Final_Weight"].to_numpy()
+    is_taxpayer = df["Is_Taxpayer"].to_numpy(dtype=bool)
+    is_top10 = df["Wealth_Rank"].to_numpy() > 0.9
 
     # Full base: no exemptions
-    df_region["FullBase_Taxable"] = df_region["Adj_Net_Wealth"]
-    df_region["Wealth_Tax_FullBase"] = df_region.apply(
-        lambda row: calculate_ip_tax(row["FullBase_Taxable"], row["Region"]), axis=1
-    )
-
-    # Actual weighted tax
-    df_region["Weighted_Wealth_Tax"] = df_region["Wealth_Tax"] * df_region["Final_Weight"]
-    df_region["Weighted_Wealth_Tax_FullBase"] = df_region["Wealth_Tax_FullBase"] * df_region["Final_Weight"]
-
-    total_revenue = df_region["Weighted_Wealth_Tax"].sum()
-    fullbase_revenue = df_region["Weighted_Wealth_Tax_FullBase"].sum()
-    exemption_gap = fullbase_revenue - total_revenue
-    exemption_gap_pct = 100 * exemption_gap / fullbase_revenue if fullbase_revenue > 0 else np.nan
-
+    wealth_tax_fullbase = calculate_ip_tax_vec(adj_net_wealth, df["Region"], region_idx=region_idx)
     # Decentralization: apply national rule (Asturias) to all
-    df_region["Wealth_Tax_BaselineRule"] = df_region["Adj_Net_Wealth"].apply(
-        lambda w: calculate_ip_tax(w, region="Asturias")
-    )
-    df_region["Weighted_Wealth_Tax_BaselineRule"] = df_region["Wealth_Tax_BaselineRule"] * df_region["Final_Weight"]
-
-    baseline_rule_revenue = df_region["Weighted_Wealth_Tax_BaselineRule"].sum()
+    wealth_tax_baseline_rule = calculate_ip_tax_vec(adj_net_wealth, "Asturias")
+
+    # Region codes in order of first occurrence; every per-region total is then a
+    # single bincount over the full frame. Missing regions get their own code
+    # (bincount rejects -1) and show up as a NaN-labelled row.
+    codes, region_names = pd.factorize(df["Region"], use_na_sentinel=False)
+    n_regions = len(region_names)
+
+    def region_sum(values, mask=None):
+        if mask is None:
+            return np.bincount(codes, weights=values, minlength=n_regions)
+        return np.bincount(codes[mask], weights=values[mask], minlength=n_regions)
+
+    total_revenue = region_sum(wealth_tax * final_weight)
+    fullbase_revenue = region_sum(wealth_tax_fullbase * final_weight)
+    baseline_rule_revenue = region_sum(wealth_tax_baseline_rule * final_weight)
+    num_taxpayers = np.bincount(codes[is_taxpayer], minlength=n_regions)
+    num_top10 = np.bincount(codes[is_top10], minlength=n_regions)
+    exemption_gap = fullbase_revenue - total_revenue
     decentralization_gap = baseline_rule_revenue - total_revenue
-    decentralization_gap_pct = 100 * decentralization_gap / total_revenue if total_revenue > 0 else np.nan
 
-    return {
-        "Region": region_name,
-        "Revenue_With_Exemptions": total_revenue,
-        "Revenue_No_Exemptions": fullbase_revenue,
-        "Exemption_Gap": exemption_gap,
-        "Exemption_Gap_%": exemption_gap_pct,
-        "BaselineRule_Revenue": baseline_rule_revenue,
-        "Decentralization_Gap": decentralization_gap,
-        "Decentralization_Gap_%": decentralization_gap_pct,
-        "Num_Taxpayers": df_region["Is_Taxpayer"].sum(),
-        "Avg_Taxpayer_ETR": (
-            df_region.loc[df_region["Is_Taxpayer"], "Wealth_Tax"].sum()
-            / df_region.loc[df_region["Is_Taxpayer"], "Adj_Net_Wealth"].sum()
-        ) if df_region["Is_Taxpayer"].any() else np.nan,
-        "Avg_Top10_ETR": (
-            df_region.loc[df_region["Wealth_Rank"] > 0.9, "Wealth_Tax"].sum()
-            / df_region.loc[df_region["Wealth_Rank"] > 0.9, "Adj_Net_Wealth"].sum()
-        ) if (df_region["Wealth_Rank"] > 0.9).any() else np.nan,
-    }
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame({
+            "Region": np.asarray(region_names),
+            "Revenue_With_Exemptions": total_revenue,
+            "Revenue_No_Exemptions": fullbase_revenue,
+            "Exemption_Gap": exemption_gap,
+            "Exemption_Gap_%": np.where(fullbase_revenue > 0, 100 * exemption_gap / fullbase_revenue, np.nan),
+            "BaselineRule_Revenue": baseline_rule_revenue,
+            "Decentralization_Gap": decentralization_gap,
+            "Decentralization_Gap_%": np.where(total_revenue > 0, 100 * decentralization_gap / total_revenue, np.nan),
+            "Num_Taxpayers": num_taxpayers,
+            "Avg_Taxpayer_ETR": np.where(
+                num_taxpayers > 0,
+                region_sum(wealth_tax, is_taxpayer) / region_sum(adj_net_wealth, is_taxpayer),
+                np.nan,
+            ),
+            "Avg_Top10_ETR": np.where(
+                num_top10 > 0, region_sum(wealth_tax, is_top10) / region_sum(adj_net_wealth, is_top10), np.nan
+            ),
+        })
 
 
 import matplotlib.pyplot as plt
 
 def compute_global_inequality_stats(df, weight_col="Final_Weight", plot=True):
-    df = df.copy()
-    df = df[(df["Adj_Net_Wealth"] >= 0) & (df[weight_col] > 0)]
-    df["Post_Tax_Wealth"] = df["Adj_Net_Wealth"] - df["Wealth_Tax"]
+    # Narrow working frame with only the columns the metrics need
+    keep = (df["Adj_Net_Wealth"] >= 0) & (df[weight_col] > 0)
+    adj_net_wealth = df.loc[keep, "Adj_Net_Wealth"]
+    df = pd.DataFrame({
+        "Adj_Net_Wealth": adj_net_wealth,
+        "Post_Tax_Wealth": adj_net_wealth - df.loc[keep, "Wealth_Tax"],
+        weight_col: df.loc[keep, weight_col],
+    })
 
     def weighted_gini(x, w):
         sorted_idx = np.argsort(x)
-        x = x[sorted_idx]
         w = w[sorted_idx]
-        cumw = np.cumsum(w)
-        cumxw = np.cumsum(x * w)
-        return 1 - 2 * np.sum(w * (cumxw - x * w / 2)) / (cumw[-1] * cumxw[-1])
-
-    def share(df, col, pct):
-        df = df[df[col] > 0].sort_values(col, ascending=False).copy()
-        df["cum_w"] = df[weight_col].cumsum()
-        cutoff = df[weight_col].sum() * pct
-        top = df[df["cum_w"] <= cutoff]
-        return (top[col] * top[weight_col]).sum() / (df[col] * df[weight_col]).sum()
+        xw = x[sorted_idx] * w
+        cumxw = np.cumsum(xw)
+        total_xw = cumxw[-1]
+        # Midpoint rule, reusing the two buffers instead of new temporaries
+        xw *= 0.5
+        cumxw -= xw
+        return 1 - 2 * np.dot(w, cumxw) / (w.sum() * total_xw)
+
+    def top_shares(col, pcts):
+        x = df[col].to_numpy()
+        positive = x > 0
+        return top_weighted_shares(x[positive], df[weight_col].to_numpy()[positive], pcts)
 
     gini_pre = weighted_gini(df["Adj_Net_Wealth"].values, df[weight_col].values)
     gini_post = weighted_gini(df["Post_Tax_Wealth"].values, df[weight_col].values)
 
+    pre_top1, pre_top10 = top_shares("Adj_Net_Wealth", [0.01, 0.10])
+    post_top1, post_top10 = top_shares("Post_Tax_Wealth", [0.01, 0.10])
     shares = {
-        "Top 1% (Pre-Tax)": share(df, "Adj_Net_Wealth", 0.01),
-        "Top 1% (Post-Tax)": share(df, "Post_Tax_Wealth", 0.01),
-        "Top 10% (Pre-Tax)": share(df, "Adj_Net_Wealth", 0.10),
-        "Top 10% (Post-Tax)": share(df, "Post_Tax_Wealth", 0.10),
+        "Top 1% (Pre-Tax)": pre_top1,
+        "Top 1% (Post-Tax)": post_top1,
+        "Top 10% (Pre-Tax)": pre_top10,
+        "Top 10% (Post-Tax)": post_top10,
     }
 
     # Lorenz Curve
     if plot:
-        df_sorted = df.sort_values("Adj_Net_Wealth")
-        cumw = np.cumsum(df_sorted[weight_col]) / df_sorted[weight_col].sum()
-        cumx = np.cumsum(df_sorted["Adj_Net_Wealth"] * df_sorted[weight_col]) / (df_sorted["Adj_Net_Wealth"] * df_sorted[weight_col]).sum()
+        x = df["Adj_Net_Wealth"].to_numpy()
+        w = df[weight_col].to_numpy()
+        order = np.argsort(x)
+        # Cumulative shares with the (0, 0) origin written into preallocated buffers
+        cumw = np.zeros(len(order) + 1)
+        cumx = np.zeros(len(order) + 1)
+        np.cumsum(w[order], out=cumw[1:])
+        np.cumsum(x[order] * w[order], out=cumx[1:])
+        cumw /= cumw[-1]
+        cumx /= cumx[-1]
         plt.figure(figsize=(6, 6))
-        plt.plot(np.insert(cumw, 0, 0), np.insert(cumx, 0, 0), label="Pre-Tax Lorenz")
+        plt.plot(cumw, cumx, label="Pre-Tax Lorenz")
         plt.plot([0, 1], [0, 1], '--', color='gray', label="Equality")
         plt.title("Lorenz Curve (Pre-Tax Wealth)")
         plt.xlabel("Cumulative Population Share")
@@ -987,8 +1198,13 @@ def compute_global_inequality_stats(df, weight_col="Final_Weight", plot=True):
         **shares
     }
 
-def main():
-    summary_rows = []
+def main(individuals_path="simulated_thesis.csv"):
+    """
+    Run the full baseline pipeline. `individuals_path` is where the per-individual
+    frame is exported; pass None to skip that write (it is by far the slowest
+    output step) when only the printed metrics and the region summary are needed.
+    """
+    summary_df = pd.DataFrame()
     try:
         POP_FILE = "Regional_Age_Bin_Population_Shares.csv"
         INCOME_FILE = "eff_incomedata.csv"
@@ -1001,16 +1217,8 @@ def main():
         _, group_stats_df = process_eff_assets_income(eff_df)
         revenue_df, region_weights = load_population_and_revenue_data(POP_FILE)
 
-        # Normalize wealth groups
-        valid_wealth_groups = [
-            "under 25",
-            "between 25 and 50",
-            "between 50 and 75",
-            "between 75 and 90",
-            "between 90 and 100"
-        ]
-        group_stats_df["Category"] = group_stats_df["Category"].str.lower().str.strip()
-        group_stats_df = group_stats_df[group_stats_df["Category"].isin(valid_wealth_groups)]
+        # Wealth-group labels are normalized at read time in load_eff_data
+        group_stats_df = group_stats_df[group_stats_df["Category"].isin(VALID_WEALTH_CATEGORIES)]
 
         # === SYNTHETIC HOUSEHOLD GENERATION ===
         simulated_population = int(150_000 * 1.6)
@@ -1024,6 +1232,9 @@ def main():
         )
 
         assert "Household_Size" in individuals.columns, "❌ Household_Size missing."
+        # Region stays categorical from here on: normalize the labels once so masks
+        # and groupbys compare integer codes
+        individuals["Region"] = normalize_region_categories(individuals["Region"])
         individuals["Final_Weight"] = 1.0
         individuals = inject_calibrated_pareto_tail(
             individuals,
@@ -1034,30 +1245,22 @@ def main():
 
         individuals["Total_Assets_Pareto"] = individuals["Total_Assets"]
 
-        df_sorted = individuals.sort_values("Total_Assets", ascending=False)
-        cum_weights = df_sorted["Final_Weight"].cumsum()
-        total_weight = cum_weights.iloc[-1]
-
-        top_1_mask = cum_weights <= 0.01 * total_weight
-        top_10_mask = cum_weights <= 0.10 * total_weight
-
-        top_1_share = (df_sorted.loc[top_1_mask, "Total_Assets"] * df_sorted.loc[top_1_mask, "Final_Weight"]).sum() / \
-                      (df_sorted["Total_Assets"] * df_sorted["Final_Weight"]).sum()
-
-        top_10_share = (df_sorted.loc[top_10_mask, "Total_Assets"] * df_sorted.loc[top_10_mask, "Final_Weight"]).sum() / \
-                       (df_sorted["Total_Assets"] * df_sorted["Final_Weight"]).sum()
+        top_1_share, top_10_share = top_weighted_shares(
+            individuals["Total_Assets"].to_numpy(), individuals["Final_Weight"].to_numpy(), [0.01, 0.10]
+        )
 
         print(f"Top 1% share after Pareto: {top_1_share:.2%}")
         print(f"Top 10% share after Pareto: {top_10_share:.2%}")
 
         # === Tax Simulation ===
-        taxed_individuals = individuals.copy()
-        taxed_individuals["Taxable_Wealth_FullBase"] = taxed_individuals["Net_Wealth"]
-        taxed_individuals = run_tax_simulation(individuals)
-        taxed_individuals.loc[taxed_individuals["Region"].str.lower() == "madrid", "Wealth_Tax"] = 0.0
+        # One erosion stream for both dropout draws, independent of the seed-42 streams
+        # used during household generation
+        erosion_rng = np.random.default_rng(np.random.SeedSequence(42).spawn(1)[0])
+        taxed_individuals = run_tax_simulation(individuals, rng=erosion_rng)
+        taxed_individuals.loc[taxed_individuals["Region"] == "madrid", "Wealth_Tax"] = 0.0
 
 
-        taxed_individuals = assign_erosion(taxed_individuals, max_erosion=0.30, verbose=True)
+        taxed_individuals = assign_erosion(taxed_individuals, max_erosion=0.30, verbose=True, rng=erosion_rng)
         taxed_individuals = apply_migration_module(
             taxed_individuals,
             thresholds={"top_01": 0.999, "top_1": 0.99, "top_5": 0.95},
@@ -1066,35 +1269,23 @@ def main():
             verbose=True
         )
         taxed_individuals["Taxable_Wealth_Baseline"] = taxed_individuals["Net_Tax_Base"]
-        taxed_individuals["Wealth_Tax_Baseline"] = taxed_individuals.apply(
-            lambda row: calculate_ip_tax(row["Taxable_Wealth_Baseline"], row["Region"]), axis=1
+        # Resolve each row's bracket schedule once and share it between the baseline
+        # tax and the region summary's full-base tax
+        ip_region_idx = ip_tax_region_index(taxed_individuals["Region"], len(taxed_individuals))
+        taxed_individuals["Wealth_Tax_Baseline"] = calculate_ip_tax_vec(
+            taxed_individuals["Taxable_Wealth_Baseline"].to_numpy(), region_idx=ip_region_idx
         )
 
         taxed_individuals, erosion_summary = apply_baseline_behavioral_erosion(taxed_individuals, verbose=True)
 
-        summary_rows = []
-
-        for region in taxed_individuals["Region"].unique():
-            region_df = taxed_individuals[taxed_individuals["Region"] == region].copy()
-
-            # Recalculate tax under Asturias rule
-            df_asturias = region_df.copy()
-            df_asturias["Wealth_Tax"] = df_asturias.apply(
-                lambda row: calculate_ip_tax(row["Taxable_Wealth_Baseline"], "Asturias"), axis=1
-            )
-
-            # Compute summary row
-            summary_row = generate_region_summary(
-                df_region=region_df,
-                region_name=region,
-            )
-            summary_rows.append(summary_row)
+        summary_df = generate_region_summaries(taxed_individuals, region_idx=ip_region_idx)
 
         generate_tax_diagnostics(taxed_individuals)
 
         inequality_summary = compute_global_inequality_stats(taxed_individuals, weight_col="Final_Weight", plot=True)
         print(inequality_summary)
-        taxed_individuals.to_csv("simulated_thesis.csv", index=False)
+        if individuals_path is not None:
+            taxed_individuals.to_csv(individuals_path, index=False)
 
         compare_to_observed(taxed_individuals)
 
@@ -1102,10 +1293,15 @@ def main():
         logging.exception(f"Pipeline execution failed: {e}")
         print("⚠️ Simulation failed due to error above.")
 
-    summary_df = pd.DataFrame(summary_rows)
     summary_df.to_csv("region_policy_comparison_summary.csv", index=False)
     print("📊 Exported region comparison summary to region_policy_comparison_summary.csv")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Baseline wealth-tax simulation for the Spanish regions.")
+    parser.add_argument("--individuals-path", default="simulated_thesis.csv",
+                        help="where to export the per-individual frame (default: %(default)s)")
+    parser.add_argument("--no-export", action="store_true",
+                        help="skip the per-individual CSV export (the slowest output step)")
+    args = parser.parse_args()
+    main(individuals_path=None if args.no_export else args.individuals_path)
@@ -206,12 +206,11 @@ def _validate_eff_elements(eff: pd.DataFrame) -> None:
 
 
 def _pivot_eff_assets(eff: pd.DataFrame) -> pd.DataFrame:
-    return eff.pivot_table(
-        index="Category",
-        columns="Element",
-        values="Value",
-        aggfunc="mean",
-    ).fillna(0)
+    return (
+        eff.groupby(["Category", "Element"])["Value"]
+        .mean()
+        .unstack("Element", fill_value=0.0)
+    )
 
 
 def _compute_totals(pv: pd.DataFrame) -> pd.DataFrame: